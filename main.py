@@ -7,6 +7,11 @@ sync_ssd.py - Two-way synchronization with backup to SSD
 • Creates full file copies in the .backups/<PAIR>/<TIMESTAMP>/ directory before any
   operation that changes the SSD content
 • Keeps backups for RETENTION_DAYS, then deletes them
+• Caches directory listings in .backups/<PAIR>/.scan_cache to skip unchanged readdirs
+• Adapts the mtime tolerance to the SSD's timestamp resolution (2 s on FAT) and skips
+  equal-size files whose mtimes differ by a timezone shift but whose contents match
+• Optionally verifies copies (probe, or full checksum with --deep-verify) before they
+  replace the target
 • Has a --dry-run mode, logging, and a lock file in the system TEMP directory
 
 Example usage:
@@ -23,94 +28,332 @@ Configuration parameters (YAML):
     backup_root: /Volumes/EXT/.backups
     retention_days: 14
     delete_policy: safe   # safe | mirror | sync
+    verify: false         # check size + first/last 64 KiB of every copy (--deep-verify: full hash)
+    hash_algo: blake3     # blake3 (if installed) | sha256 | any hashlib name
+    preserve: mtime       # mtime (mode + times) | full (also flags, xattrs)
 
-Dependencies: Python≥3.8, PyYAML (pip install pyyaml)
+Dependencies: Python≥3.8, PyYAML (pip install pyyaml), optional blake3 (pip install blake3)
 """
 import argparse
+import errno
 import hashlib
+import json
 import logging
 import os
 import shutil
+import sys
 import tempfile
+import threading
+import time
+from array import array
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from contextlib import contextmanager
 from datetime import datetime, timedelta
+from functools import partial
 from pathlib import Path
-from typing import Dict, List, Tuple
+from stat import S_IMODE, S_ISREG
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
 
 import yaml
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+try:
+    import blake3
+except ImportError:  # optional, only needed for hash_algo: blake3
+    blake3 = None
+
 LOG = logging.getLogger("sync_ssd")
 
 # -----------------------  LOCK‑FILE UTILITIES  ----------------------- #
 
 @contextmanager
 def single_instance_lock(lock_path: Path):
-    """Create a simple lock file; fail if it already exists"""
+    """Hold an exclusive advisory lock on lock_path; the OS drops it if the process dies"""
+    fd = os.open(lock_path, os.O_CREAT | os.O_RDWR, 0o644)
     try:
-        fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_RDWR)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+        except (BlockingIOError, PermissionError):
+            raise RuntimeError(f"Another instance is running (lock {lock_path})") from None
+        os.ftruncate(fd, 0)
         os.write(fd, str(os.getpid()).encode())
-        os.close(fd)
         LOG.debug("Acquired lock %s", lock_path)
         yield
+        LOG.debug("Released lock %s", lock_path)
     finally:
-        try:
-            lock_path.unlink()
-            LOG.debug("Released lock %s", lock_path)
-        except FileNotFoundError:
-            pass
+        os.close(fd)  # releases the lock; the file itself is left in place
 
 # -----------------------  FILE META & DIFF  ------------------------- #
 
-class FileMeta:
-    __slots__ = ("size", "mtime")
-
-    def __init__(self, size: int, mtime: float):
-        self.size = size
-        self.mtime = mtime
+MTIME_TOLERANCE = 1e-3  # 1 ms
+# Coarse timestamp granularities seen on removable media: FAT (2 s), HFS+/ext3 (1 s), exFAT (10 ms)
+MTIME_RESOLUTIONS = (2.0, 1.0, 0.01)
+_PROBE_MTIME_NS = 1_000_000_001_234_567_891  # odd second, not a multiple of any resolution above
 
-    def newer_than(self, other: "FileMeta") -> bool:
-        return self.mtime > other.mtime + 1e-3  # 1 ms tolerance
 
-
-def scan_tree(root: Path) -> Dict[Path, "FileMeta"]:
-    """Returns a dictionary rel_path → FileMeta"""
-    meta: Dict[Path, FileMeta] = {}
-    for path in root.rglob("*"):
-        if not path.is_file():
-            continue
-        rel = path.relative_to(root)
-        stat = path.stat()
-        meta[rel] = FileMeta(stat.st_size, stat.st_mtime)
-    return meta
-
-
-Action = Tuple[str, Path]  # (COPY_LOCAL_TO_SSD | COPY_SSD_TO_LOCAL | DELETE | UPDATE), rel_path
-
-
-def build_diff(local: Dict[Path, FileMeta], ssd: Dict[Path, FileMeta], delete_policy: str) -> List[Action]:
-    plan: List[Action] = []
-    all_paths = set(local) | set(ssd)
-    for rel in sorted(all_paths):
-        in_local = rel in local
-        in_ssd = rel in ssd
-        if in_local and not in_ssd:
-            plan.append(("COPY_LOCAL_TO_SSD", rel))
-        elif in_ssd and not in_local:
-            if delete_policy == "mirror":
-                plan.append(("DELETE_SSD", rel))
-            elif delete_policy == "sync":
-                plan.append(("COPY_SSD_TO_LOCAL", rel))
-            else:
-                pass
-        else:  # both present
-            l_meta = local[rel]
-            s_meta = ssd[rel]
-            if l_meta.newer_than(s_meta):
-                plan.append(("UPDATE_SSD", rel))
-            elif s_meta.newer_than(l_meta):
-                plan.append(("COPY_SSD_TO_LOCAL", rel))
-            # else identical - do nothing
-    return plan
+def mtime_resolution(root: Path) -> Optional[float]:
+    """Measures how coarsely root's filesystem stores mtimes by round-tripping a probe file.
+    The probe changes root's mtime, which is harmless: scan_dir never caches the root.
+    Returns None if the probe cannot be written (full, read-only or unmounted volume)."""
+    probe = root / ".sync_ssd_mtime_probe"
+    try:
+        probe.touch()
+        os.utime(probe, ns=(_PROBE_MTIME_NS, _PROBE_MTIME_NS))
+        stored_ns = probe.stat().st_mtime_ns
+    except OSError:
+        return None
+    finally:
+        try:
+            probe.unlink()
+        except OSError:
+            pass
+    for resolution in MTIME_RESOLUTIONS:
+        if stored_ns % int(resolution * 1e9) == 0:
+            return resolution
+    return MTIME_TOLERANCE
+
+
+class TreeIndex(NamedTuple):
+    """Scan result as parallel arrays: names[i] has sizes[i], mtimes[i] and inos[i]"""
+    names: List[str]
+    sizes: array
+    mtimes: array
+    inos: array
+
+    @classmethod
+    def empty(cls) -> "TreeIndex":
+        return cls([], array("q"), array("d"), array("Q"))
+
+    def add(self, name: str, st: os.stat_result):
+        self.names.append(name)
+        self.sizes.append(st.st_size)
+        self.mtimes.append(st.st_mtime)
+        self.inos.append(st.st_ino)
+
+    def index(self) -> Dict[str, int]:
+        """Returns name → position in the arrays"""
+        return {name: i for i, name in enumerate(self.names)}
+
+
+SCAN_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+SCAN_CACHE_NAME = ".scan_cache"
+
+# Directory listing cache: rel_prefix → [dir mtime_ns, file names, subdir names].
+# A directory's mtime only changes when entries are added, removed or renamed, so
+# a hit skips the readdir but every file is still stat'ed to catch in-place edits.
+# The root is never cached: FAT roots have no stored mtime (vfat reports 0), and the
+# resolution probe writes into the SSD root. FAT subdirectories are only
+# trustworthy at fine resolution, so process_pair drops the SSD side entirely on
+# coarse-mtime volumes; the measured resolution is kept under "mtime_resolution"
+# so the SSD is only probed once per pair. A listing is only stored once its
+# directory mtime is RACY_WINDOW_NS older than the scan: on 1-2 s resolution
+# volumes an entry added right after the readdir can leave that mtime unchanged.
+ScanCache = Dict[str, list]
+RACY_WINDOW_NS = int(max(MTIME_RESOLUTIONS) * 1e9)
+# In-progress copies (see temp_path_for); never listed as files
+TMP_SUFFIX = ".sync_ssd.tmp"
+
+
+def scan_dir(path: str, prefix: str, cache: Optional[ScanCache] = None,
+             previous: Optional[ScanCache] = None) -> Tuple[TreeIndex, List[str]]:
+    """Lists one directory: its regular files (named prefix + name) and its subdirectory names.
+
+    With a cache, a directory's entry is taken out of previous and reused if its
+    mtime still matches, and the current listing is stored in cache under prefix
+    unless the directory changed within RACY_WINDOW_NS of the scan. The root
+    (empty prefix) is always read.
+    """
+    if not prefix:
+        cache = None
+    files = TreeIndex.empty()
+    try:
+        if cache is not None:
+            scan_ns = time.time_ns()
+            mtime_ns = os.stat(path).st_mtime_ns
+            hit = previous.pop(prefix, None)  # frees stale listings as the walk goes
+            if hit is not None and hit[0] == mtime_ns:
+                for name in hit[1]:
+                    try:
+                        st = os.lstat(os.path.join(path, name))
+                    except FileNotFoundError:
+                        continue  # file removed since the listing was cached
+                    if S_ISREG(st.st_mode):
+                        files.add(prefix + name, st)
+                cache[prefix] = hit
+                return files, hit[2]
+
+        names: List[str] = []
+        subdirs: List[str] = []
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_symlink():
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+                elif entry.is_file(follow_symlinks=False):
+                    if entry.name.endswith(TMP_SUFFIX):
+                        continue
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue  # file removed between readdir and stat
+                    names.append(entry.name)
+                    files.add(prefix + entry.name, st)
+    except FileNotFoundError:
+        return files, []  # directory vanished while scanning
+    except OSError as e:
+        LOG.warning("Cannot scan %s: %s", path, e)
+        return files, []
+    if cache is not None and mtime_ns < scan_ns - RACY_WINDOW_NS:
+        cache[prefix] = [mtime_ns, names, subdirs]
+    return files, subdirs
+
+
+def load_scan_cache(path: Path, roots: List[str]) -> dict:
+    """Loads the cache written for these (local, ssd) roots; any other cache starts empty"""
+    try:
+        with path.open("r", encoding="utf-8") as f:
+            cache = json.load(f)
+    except (FileNotFoundError, ValueError):
+        cache = {}
+    if not isinstance(cache, dict) or cache.get("roots") != roots:
+        cache = {"roots": roots}  # e.g. two pairs whose SSD folders share a name
+    return cache
+
+
+def save_scan_cache(path: Path, cache: dict):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    with tmp.open("w", encoding="utf-8") as f:
+        json.dump(cache, f)
+    os.replace(tmp, path)  # atomic operation
+
+
+Action = Tuple[str, str]  # (COPY_LOCAL_TO_SSD | COPY_SSD_TO_LOCAL | DELETE | UPDATE | TOUCH), rel_path
+
+# Same bytes, different mtime: copy only the mtime so the pair matches next run
+TOUCH_ACTIONS = {"UPDATE_SSD": "TOUCH_SSD", "COPY_SSD_TO_LOCAL": "TOUCH_LOCAL"}
+# FAT stores local time, so a timezone or DST change shifts every mtime by a multiple
+# of 15 minutes (UTC-12 … UTC+14); only such differences are worth a content check
+TZ_SHIFT_STEP = 15 * 60.0
+TZ_SHIFT_MAX = 26 * 3600.0
+
+
+def looks_tz_shifted(delta: float, tolerance: float) -> bool:
+    """True if a positive mtime difference is a whole number of timezone steps"""
+    steps = round(delta / TZ_SHIFT_STEP)
+    return 0 < steps and delta <= TZ_SHIFT_MAX + tolerance and abs(delta - steps * TZ_SHIFT_STEP) <= tolerance
+
+
+# What to do with a file that exists only on the SSD; unknown policies behave like "safe"
+SSD_ONLY_ACTIONS: Dict[str, Optional[str]] = {"mirror": "DELETE_SSD", "sync": "COPY_SSD_TO_LOCAL", "safe": None}
+
+
+def build_diff(local: TreeIndex, ssd: TreeIndex, delete_policy: str, tolerance: float = MTIME_TOLERANCE,
+               identical: Optional[Callable[[List[str]], List[bool]]] = None) -> List[Action]:
+    """Returns the actions for two listings; mtimes closer than tolerance count as equal.
+
+    If identical is given, files of equal size whose mtimes differ by a timezone
+    shift (looks_tz_shifted) are passed to it in one batch, and those it reports as
+    identical in content only get their target's mtime aligned (TOUCH_SSD /
+    TOUCH_LOCAL) instead of a copy. Any other difference is a real edit.
+    """
+    ssd_only_action = SSD_ONLY_ACTIONS.get(delete_policy)  # resolved once, not per file
+    l_index = local.index()
+    s_index = ssd.index()
+    l_names = l_index.keys()
+    s_names = s_index.keys()
+
+    # set algebra on the key views runs in C; only the shared names need a Python loop
+    only_local = list(l_names - s_names)
+    plan: List[Action] = [("COPY_LOCAL_TO_SSD", rel) for rel in only_local]
+    src_inos: List[int] = [local.inos[l_index[rel]] for rel in only_local]  # parallel to plan
+    if ssd_only_action is not None:
+        only_ssd = list(s_names - l_names)
+        plan += [(ssd_only_action, rel) for rel in only_ssd]
+        src_inos += [ssd.inos[s_index[rel]] for rel in only_ssd]
+    l_mtimes, s_mtimes = local.mtimes, ssd.mtimes
+    suspects: List[Tuple[int, Action]] = []  # same size, mtime shifted: maybe the same bytes
+    for rel in l_names & s_names:
+        i = l_index[rel]
+        j = s_index[rel]
+        l_mtime = l_mtimes[i]
+        s_mtime = s_mtimes[j]
+        if l_mtime > s_mtime + tolerance:
+            action, ino = ("UPDATE_SSD", rel), local.inos[i]
+        elif s_mtime > l_mtime + tolerance:
+            action, ino = ("COPY_SSD_TO_LOCAL", rel), ssd.inos[j]
+        else:
+            continue  # identical - do nothing
+        if (identical is not None and local.sizes[i] == ssd.sizes[j]
+                and looks_tz_shifted(abs(l_mtime - s_mtime), tolerance)):
+            suspects.append((ino, action))
+        else:
+            plan.append(action)
+            src_inos.append(ino)
+    if suspects:
+        same = identical([rel for _, (_, rel) in suspects])
+        for (ino, (kind, rel)), is_same in zip(suspects, same):
+            plan.append((TOUCH_ACTIONS[kind], rel) if is_same else (kind, rel))
+            src_inos.append(ino)
+
+    # Execute in inode order of the file being read: sequential inode-table/extent access
+    # (within one directory when called from stream_diff)
+    order = sorted(range(len(plan)), key=src_inos.__getitem__)
+    return [plan[k] for k in order]
+
+
+def stream_diff(local_root: Path, ssd_root: Path, delete_policy: str,
+                cache: Optional[Dict[str, ScanCache]] = None, tolerance: float = MTIME_TOLERANCE,
+                identical: Optional[Callable[[List[str]], List[bool]]] = None) -> Iterator[Action]:
+    """Walks both trees in lockstep and yields the actions one directory at a time.
+
+    Without a cache only listings of directories waiting on the stack are held in
+    memory. A cache holds the names of every directory on the side it covers, so
+    memory then grows with the total number of files; entries of the previous run
+    are released as their directories are visited. Subdirectory listings are read
+    ahead on SCAN_WORKERS threads while the caller consumes actions. If cache is
+    given, its "local" and "ssd" entries, where present, are used and rewritten as
+    in scan_dir. tolerance and identical go to build_diff.
+    """
+    ssd_only_action = SSD_ONLY_ACTIONS.get(delete_policy)
+
+    def lister(root: Path, side: str) -> Callable[[str], Tuple[TreeIndex, List[str]]]:
+        side_cache = previous = None
+        if cache is not None and side in cache:
+            side_cache = cache[side]
+            previous = dict(side_cache)
+            side_cache.clear()
+        base = os.fspath(root)
+        return lambda prefix: scan_dir(os.path.join(base, prefix), prefix, side_cache, previous)
+
+    list_local = lister(local_root, "local")
+    list_ssd = lister(ssd_root, "ssd")
+    with ThreadPoolExecutor(max_workers=SCAN_WORKERS) as pool:
+        stack = [("", pool.submit(list_local, ""), pool.submit(list_ssd, ""))]
+        while stack:
+            prefix, l_job, s_job = stack.pop()
+            l_files, l_dirs = l_job.result() if l_job else (TreeIndex.empty(), [])
+            s_files, s_dirs = s_job.result() if s_job else (TreeIndex.empty(), [])
+            l_dirs = set(l_dirs)
+            s_dirs = set(s_dirs)
+            for name in l_dirs | s_dirs:
+                in_local = name in l_dirs
+                if not in_local and ssd_only_action is None:
+                    continue  # nothing below an SSD-only directory needs an action
+                sub = prefix + name + os.sep
+                stack.append((sub,
+                              pool.submit(list_local, sub) if in_local else None,
+                              pool.submit(list_ssd, sub) if name in s_dirs else None))
+            yield from build_diff(l_files, s_files, delete_policy, tolerance, identical)
 
 # -----------------------  BACKUP & FILE OPS  ------------------------ #
 
@@ -121,16 +364,113 @@ def make_ts_folder(backup_root: Path, pair_name: str) -> Path:
     return folder
 
 
-def copy_for_backup(src: Path, dst: Path):
+def copy_for_backup(src: Path, dst: Path, preserve: str = "mtime"):
     dst.parent.mkdir(parents=True, exist_ok=True)
-    shutil.copy2(src, dst)
+    copy_data(src, dst)
+    copy_metadata(src, dst, preserve)
+
+
+KERNEL_COPY_CHUNK = 1 << 30
+# errnos meaning "no in-kernel copy between these two files", not a real I/O error
+_NO_KERNEL_COPY = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOTSOCK}
+
+
+def _rewind(infd: int, outfd: int):
+    os.lseek(infd, 0, os.SEEK_SET)
+    os.lseek(outfd, 0, os.SEEK_SET)
+    os.ftruncate(outfd, 0)
+
+
+def _kernel_copy(infd: int, outfd: int) -> bool:
+    """Copies infd → outfd without a user-space buffer; False if no in-kernel path works"""
+    size = os.fstat(infd).st_size
+    calls = []
+    if hasattr(os, "copy_file_range"):
+        calls.append(lambda: os.copy_file_range(infd, outfd, KERNEL_COPY_CHUNK))
+    if sys.platform.startswith("linux"):
+        calls.append(lambda: os.sendfile(outfd, infd, None, KERNEL_COPY_CHUNK))
+    for call in calls:
+        copied = 0
+        try:
+            while True:
+                n = call()
+                if not n:
+                    break
+                copied += n
+        except OSError as e:
+            if e.errno not in _NO_KERNEL_COPY:
+                raise
+            _rewind(infd, outfd)  # try the next method from scratch
+            continue
+        if copied == 0 and size > 0:
+            # some filesystems report 0 bytes instead of an error; treat as unsupported
+            _rewind(infd, outfd)
+            continue
+        if copied < size:
+            # a source that grows while copied (e.g. an appended log) is fine: it is copied as read
+            raise OSError(errno.EIO, f"Short copy: {copied} of {size} bytes (source truncated?)")
+        return True
+    return False
+
+
+DROP_CACHE_MIN = 16 << 20  # 16 MiB
+
+
+def _drop_cache(fd: int, size: int, written: bool = False):
+    """Drops a large file's pages so bulk copies do not evict the dentries/inodes the next scan needs"""
+    if size >= DROP_CACHE_MIN and hasattr(os, "posix_fadvise"):
+        if written:
+            # DONTNEED skips dirty pages, so flush the new data first to make them droppable
+            os.fdatasync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def copy_data(src: Path, dst: Path):
+    """Copies file contents only: copy_file_range → sendfile → shutil.copyfile"""
+    with src.open("rb") as fsrc, dst.open("wb") as fdst:
+        infd, outfd = fsrc.fileno(), fdst.fileno()
+        if _kernel_copy(infd, outfd):
+            size = os.fstat(infd).st_size
+            _drop_cache(infd, size)
+            _drop_cache(outfd, size, written=True)
+            return
+    shutil.copyfile(src, dst)  # uses fcopyfile(3) on macOS
+
+
+PRESERVE_MODES = ("mtime", "full")
+
 
+def copy_metadata(src: Path, dst: Path, preserve: str = "mtime"):
+    """mtime: permission bits and access/modify times; full: shutil.copystat (also flags, xattrs)"""
+    if preserve == "full":
+        shutil.copystat(src, dst)
+    else:
+        st = src.stat()
+        try:
+            os.chmod(dst, S_IMODE(st.st_mode))
+        except PermissionError:
+            pass  # e.g. vfat without the quiet option cannot store permission bits
+        os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+
+def temp_path_for(dst: Path) -> Path:
+    """Creates a uniquely named empty file next to dst, so no other file's copy can use it"""
+    # the name is shortened so the prefix and random part stay within NAME_MAX
+    fd, name = tempfile.mkstemp(dir=dst.parent, prefix=f".{dst.name[:64]}.", suffix=TMP_SUFFIX)
+    os.close(fd)
+    return Path(name)
 
-def safe_copy(src: Path, dst: Path):
-    tmp = dst.with_suffix(dst.suffix + ".tmp")
+
+def safe_copy(src: Path, dst: Path, preserve: str = "mtime"):
     dst.parent.mkdir(parents=True, exist_ok=True)
-    shutil.copy2(src, tmp)
-    os.replace(tmp, dst)  # atomic operation
+    tmp = temp_path_for(dst)
+    try:
+        copy_data(src, tmp)
+        copy_metadata(src, tmp, preserve)
+        os.replace(tmp, dst)  # atomic operation
+    except BaseException:
+        tmp.unlink(missing_ok=True)  # a leftover would be synced back as an SSD-only file
+        raise
 
 
 def delete_path(path: Path):
@@ -139,76 +479,262 @@ def delete_path(path: Path):
 # -----------------------  RETENTION CLEAN  -------------------------- #
 
 def purge_old_backups(pair_backup_dir: Path, retention_days: int):
-    if not pair_backup_dir.exists():
-        return
     now = datetime.now()
-    for ts_dir in pair_backup_dir.iterdir():
-        try:
-            ts = datetime.strptime(ts_dir.name, "%Y%m%d-%H%M%S")
-        except ValueError:
-            continue  # skip unrelated files
-        if now - ts > timedelta(days=retention_days):
-            shutil.rmtree(ts_dir)
-            LOG.info("Removed old backup %s", ts_dir)
+    try:
+        it = os.scandir(pair_backup_dir)
+    except FileNotFoundError:
+        return
+    with it:
+        for entry in it:
+            if not entry.is_dir(follow_symlinks=False):
+                continue  # skip unrelated files such as the scan cache
+            try:
+                ts = datetime.strptime(entry.name, "%Y%m%d-%H%M%S")
+            except ValueError:
+                continue  # skip unrelated directories
+            if now - ts > timedelta(days=retention_days):
+                shutil.rmtree(entry.path)
+                LOG.info("Removed old backup %s", entry.path)
 
 # -----------------------  VERIFY HELPERS   -------------------------- #
 
-def sha256_of(path: Path, chunk: int = 1 << 20) -> str:
-    h = hashlib.sha256()
-    with path.open("rb") as f:
-        while True:
-            b = f.read(chunk)
-            if not b:
-                break
-            h.update(b)
+HASH_CHUNK = 1 << 23  # 8 MiB, in line with SSD readahead
+DEFAULT_HASH = "blake3" if blake3 is not None else "sha256"
+
+
+def new_hash(algo: str = DEFAULT_HASH):
+    """Returns a hash object for "blake3" or any hashlib algorithm name"""
+    if algo == "blake3":
+        if blake3 is None:
+            raise ValueError("hash_algo blake3 needs the blake3 package (pip install blake3)")
+        return blake3.blake3(max_threads=blake3.blake3.AUTO)
+    return hashlib.new(algo)
+
+
+HASH_JOBS = 4  # beyond ~4 concurrent hashes threads mostly contend for memory bandwidth
+_hash_jobs = HASH_JOBS
+_hash_slots = threading.BoundedSemaphore(HASH_JOBS)
+
+
+def set_hash_jobs(jobs: int):
+    """Sets how many files may be hashed at once, by verify_many and across all threads"""
+    global _hash_jobs, _hash_slots
+    _hash_jobs = jobs
+    _hash_slots = threading.BoundedSemaphore(jobs)
+
+
+def digest_of(path: Path, algo: str = DEFAULT_HASH, chunk: int = HASH_CHUNK) -> str:
+    h = new_hash(algo)
+    with path.open("rb", buffering=0) as f:
+        if os.fstat(f.fileno()).st_size < chunk:
+            # one read; zero-filling a chunk-sized buffer would cost more than hashing
+            h.update(f.read())
+            return h.hexdigest()
+        buf = bytearray(chunk)
+        view = memoryview(buf)
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        with _hash_slots:
+            while True:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                h.update(view[:n])
     return h.hexdigest()
 
 
-def verify_identical(a: Path, b: Path) -> bool:
-    return a.stat().st_size == b.stat().st_size and sha256_of(a) == sha256_of(b)
+PROBE_SIZE = 1 << 16  # 64 KiB
+
+
+def probe_of(path: Path, size: int) -> bytes:
+    """Returns the first and last PROBE_SIZE bytes (the whole file if it is smaller)"""
+    with path.open("rb") as f:
+        if size <= 2 * PROBE_SIZE:
+            return f.read()
+        head = f.read(PROBE_SIZE)
+        f.seek(-PROBE_SIZE, os.SEEK_END)
+        return head + f.read(PROBE_SIZE)
+
+
+def verify_identical(a: Path, b: Path, algo: str = DEFAULT_HASH, deep: bool = False) -> bool:
+    """Compares size, then the head/tail probe; hashes the full contents only if deep"""
+    size = a.stat().st_size
+    if b.stat().st_size != size or probe_of(a, size) != probe_of(b, size):
+        return False
+    if not deep or size <= 2 * PROBE_SIZE:
+        return True  # small files were compared in full by the probe
+    return digest_of(a, algo) == digest_of(b, algo)
+
+
+def verify_many(paths_a: List[Path], paths_b: List[Path], algo: str = DEFAULT_HASH, deep: bool = False,
+                jobs: Optional[int] = None) -> List[bool]:
+    """verify_identical over pairs of files, jobs pairs at a time; unreadable pairs count as different.
+
+    jobs defaults to the value set with set_hash_jobs (--hash-jobs).
+    """
+    def check(a: Path, b: Path) -> bool:
+        try:
+            return verify_identical(a, b, algo, deep)
+        except OSError:
+            return False
+
+    with ThreadPoolExecutor(max_workers=jobs or _hash_jobs) as pool:
+        return list(pool.map(check, paths_a, paths_b))
+
+
+def safe_copy_verified(src: Path, dst: Path, algo: str = DEFAULT_HASH, deep: bool = False,
+                       preserve: str = "mtime", chunk: int = HASH_CHUNK):
+    """safe_copy that checks the written file before the swap.
+
+    The default check is verify_identical's size + head/tail probe. With deep,
+    src is hashed while copying and the written file is hashed back in full.
+    """
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    tmp = temp_path_for(dst)
+    try:
+        _copy_verified(src, tmp, algo, deep, chunk)
+        copy_metadata(src, tmp, preserve)
+        os.replace(tmp, dst)  # atomic operation
+    except BaseException:
+        tmp.unlink(missing_ok=True)  # a leftover would be synced back as an SSD-only file
+        raise
+
+
+def _copy_verified(src: Path, tmp: Path, algo: str, deep: bool, chunk: int):
+    if not deep:
+        copy_data(src, tmp)
+        if not verify_identical(src, tmp):
+            raise OSError(errno.EIO, "Probe mismatch after copy", str(tmp))
+        return
+
+    h = new_hash(algo)
+    with src.open("rb", buffering=0) as fsrc, tmp.open("wb") as fdst:
+        buf = bytearray(min(chunk, os.fstat(fsrc.fileno()).st_size + 1))  # small files: no 8 MiB buffer
+        view = memoryview(buf)
+        with _hash_slots:
+            while True:
+                n = fsrc.readinto(buf)
+                if not n:
+                    break
+                h.update(view[:n])
+                fdst.write(view[:n])
+    # src was hashed on the way through; only the copy has to be read back
+    if digest_of(tmp, algo, chunk) != h.hexdigest():
+        raise OSError(errno.EIO, "Checksum mismatch after copy", str(tmp))
 
 # -----------------------  MAIN PER‑PAIR LOOP ------------------------ #
 
-def process_pair(local_root: Path, ssd_root: Path, backup_root: Path, retention: int, delete_policy: str, dry: bool):
+COPY_WORKERS = 8
+
+
+BACKUP_ACTIONS = ("UPDATE_SSD", "DELETE_SSD", "COPY_LOCAL_TO_SSD")
+
+
+def copy_times(src: Path, dst: Path):
+    st = src.stat()
+    os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+
+def _apply_action(action: str, rel: str, local_root: Path, ssd_root: Path, ts_folder: Optional[Path],
+                  copy: Callable[[Path, Path], None], preserve: str):
+    local_path = local_root / rel
+    ssd_path = ssd_root / rel
+    if action in BACKUP_ACTIONS:
+        # backup old version
+        if ssd_path.exists():
+            copy_for_backup(ssd_path, ts_folder / rel, preserve)
+    if action in ("COPY_LOCAL_TO_SSD", "UPDATE_SSD"):
+        copy(local_path, ssd_path)
+    elif action == "COPY_SSD_TO_LOCAL":
+        copy(ssd_path, local_path)
+    elif action == "DELETE_SSD":
+        delete_path(ssd_path)
+    elif action == "TOUCH_SSD":
+        copy_times(local_path, ssd_path)
+    elif action == "TOUCH_LOCAL":
+        copy_times(ssd_path, local_path)
+    else:
+        LOG.warning("Unknown action %s", action)
+
+
+def process_pair(local_root: Path, ssd_root: Path, backup_root: Path, retention: int, delete_policy: str, dry: bool,
+                 verify: bool, deep_verify: bool, hash_algo: str, preserve: str):
     pair_name = ssd_root.name
     LOG.info("=== Pair %s → %s ===", local_root, ssd_root)
 
     # 1) retention cleanup
     purge_old_backups(backup_root / pair_name, retention)
 
-    # 2) scan
-    local_meta = scan_tree(local_root)
-    ssd_meta = scan_tree(ssd_root)
-
-    # 3) diff
-    plan = build_diff(local_meta, ssd_meta, delete_policy)
-    LOG.info("Plan: %d actions", len(plan))
-    for action, rel in plan:
-        LOG.debug("  %s %s", action, rel)
+    # 2) scan + diff, one directory at a time
+    cache_path = backup_root / pair_name / SCAN_CACHE_NAME
+    scan_cache = load_scan_cache(cache_path, [os.fspath(local_root), os.fspath(ssd_root)])
+    tolerance = scan_cache.get("mtime_resolution")
+    if tolerance is None and dry:
+        LOG.info("SSD mtime resolution not measured yet; dry run assumes %g s", MTIME_TOLERANCE)
+    elif tolerance is None:
+        tolerance = mtime_resolution(ssd_root)
+        if tolerance is None:
+            LOG.warning("Cannot measure the SSD mtime resolution; assuming %g s for this run", MTIME_TOLERANCE)
+        else:
+            scan_cache["mtime_resolution"] = tolerance  # only a real measurement is kept
+    if tolerance is not None and tolerance > MTIME_TOLERANCE:
+        LOG.info("SSD keeps mtimes at %g s resolution; using it as tolerance", tolerance)
+    scan_cache.setdefault("local", {})
+    if tolerance is None or tolerance > MTIME_TOLERANCE:
+        # coarse or unknown resolution: directory mtimes are not a reliable change signal there
+        scan_cache.pop("ssd", None)
+    else:
+        scan_cache.setdefault("ssd", {})
+
+    def same_content(rels: List[str]) -> List[bool]:
+        # equal size, mtime off by a timezone shift: only touch the mtime if the bytes match
+        return verify_many([local_root / rel for rel in rels], [ssd_root / rel for rel in rels],
+                           hash_algo, deep=True)
+
+    actions = stream_diff(local_root, ssd_root, delete_policy, scan_cache, tolerance or MTIME_TOLERANCE,
+                          same_content)
 
     if dry:
+        plan = list(actions)
+        LOG.info("Plan: %d actions", len(plan))
+        for action, rel in sorted(plan, key=lambda item: item[1]):
+            LOG.debug("  %s %s", action, rel)
         LOG.info("Dry-run mode - not executing anything"); return
 
-    ts_folder = make_ts_folder(backup_root, pair_name)
-
-    for action, rel in plan:
-        local_path = local_root / rel
-        ssd_path = ssd_root / rel
-        try:
-            if action in ("UPDATE_SSD", "DELETE_SSD", "COPY_LOCAL_TO_SSD"):
-                # backup old version
-                if ssd_path.exists():
-                    copy_for_backup(ssd_path, ts_folder / rel)
-            if action in ("COPY_LOCAL_TO_SSD", "UPDATE_SSD"):
-                safe_copy(local_path, ssd_path)
-            elif action == "COPY_SSD_TO_LOCAL":
-                safe_copy(ssd_path, local_path)
-            elif action == "DELETE_SSD":
-                delete_path(ssd_path)
-            else:
-                LOG.warning("Unknown action %s", action)
-        except Exception as e:
-            LOG.exception("Error processing %s %s: %s", action, rel, e)
+    # 3) execute actions as the walk produces them, so copying overlaps scanning
+    if verify:
+        copy = partial(safe_copy_verified, algo=hash_algo, deep=deep_verify, preserve=preserve)
+    else:
+        copy = partial(safe_copy, preserve=preserve)
+    ts_folder: Optional[Path] = None  # created on the first action that needs a backup
+    in_flight: Dict[Future, Action] = {}
+    count = 0
+
+    def collect(done):
+        for future in done:
+            action, rel = in_flight.pop(future)
+            e = future.exception()
+            if e is not None:
+                LOG.error("Error processing %s %s: %s", action, rel, e, exc_info=e)
+
+    # build_diff emits at most one action per rel and every copy writes its own
+    # temp_path_for file, so actions never touch the same file and the
+    # backup-before-overwrite ordering stays inside _apply_action
+    with ThreadPoolExecutor(max_workers=COPY_WORKERS) as pool:
+        for action, rel in actions:
+            LOG.debug("  %s %s", action, rel)
+            if ts_folder is None and action in BACKUP_ACTIONS:
+                ts_folder = make_ts_folder(backup_root, pair_name)
+            job = pool.submit(_apply_action, action, rel, local_root, ssd_root, ts_folder, copy, preserve)
+            in_flight[job] = (action, rel)
+            count += 1
+            if len(in_flight) >= 4 * COPY_WORKERS:  # bounded backlog keeps memory flat
+                collect(wait(in_flight, return_when=FIRST_COMPLETED).done)
+        collect(wait(in_flight).done)
+    LOG.info("Applied %d actions", count)
+
+    # listings reflect scan time; directories touched above get rescanned next run
+    save_scan_cache(cache_path, scan_cache)
 
 # -----------------------  ARGPARSE & ENTRY -------------------------- #
 
@@ -228,15 +754,27 @@ def main():
     ap = argparse.ArgumentParser(description="Sync folders with SSD backups")
     ap.add_argument("--config", required=True, type=Path, help="YAML configuration file")
     ap.add_argument("--dry-run", action="store_true", help="Show plan but do not copy")
+    ap.add_argument("--deep-verify", action="store_true", help="Verify copies by full-content hash")
+    ap.add_argument("--hash-jobs", type=int, default=HASH_JOBS, metavar="N",
+                    help=f"Files hashed in parallel during verification (default {HASH_JOBS})")
     ap.add_argument("--verbose", action="store_true", help="Debug output")
     args = ap.parse_args()
+    if args.hash_jobs < 1:
+        ap.error("--hash-jobs must be at least 1")
 
     configure_logging(args.verbose)
+    set_hash_jobs(args.hash_jobs)
     cfg = load_config(args.config)
 
     backup_root = Path(cfg["backup_root"]).expanduser()
     retention = int(cfg.get("retention_days", 14))
     delete_policy = cfg.get("delete_policy", "safe")
+    verify = bool(cfg.get("verify", False)) or args.deep_verify
+    hash_algo = cfg.get("hash_algo", DEFAULT_HASH)
+    new_hash(hash_algo)  # fail early on an unknown or unavailable algorithm
+    preserve = cfg.get("preserve", "mtime")
+    if preserve not in PRESERVE_MODES:
+        raise ValueError(f"preserve must be one of {PRESERVE_MODES}, got {preserve!r}")
 
     # Use system TEMP directory for the lock file
     lock_path = Path(tempfile.gettempdir()) / "sync_ssd.lock"
@@ -250,6 +788,10 @@ def main():
                 retention,
                 delete_policy,
                 args.dry_run,
+                verify,
+                args.deep_verify,
+                hash_algo,
+                preserve,
             )
     LOG.info("All done")
 